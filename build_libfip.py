@@ -0,0 +1,36 @@
+# Builds the `_libfip` extension module used by the test scripts (CFFI out-of-line API mode).
+# Run once after `cargo build`: python build_libfip.py
+from cffi import FFI
+
+
+CDEF = '''
+typedef void (__stdcall *Pfn_DirectOutput_EnumerateCallback)(void* hDevice, void* pCtxt);
+typedef void (__stdcall *Pfn_DirectOutput_DeviceChange)(void* hDevice, bool bAdded, void* pCtxt);
+typedef void (__stdcall *Pfn_DirectOutput_PageChange)(void* hDevice, DWORD dwPage, bool bSetActive, void* pCtxt);
+typedef void (__stdcall *Pfn_DirectOutput_SoftButtonChange)(void* hDevice, DWORD dwButtons, void* pCtxt);
+
+HRESULT __stdcall DirectOutput_Initialize(const wchar_t* wszPluginName);
+HRESULT __stdcall DirectOutput_Deinitialize();
+HRESULT __stdcall DirectOutput_RegisterDeviceCallback(Pfn_DirectOutput_DeviceChange pfnCb, void* pCtxt);
+HRESULT __stdcall DirectOutput_Enumerate(Pfn_DirectOutput_EnumerateCallback pfnCb, void* pCtxt);
+HRESULT __stdcall DirectOutput_RegisterPageCallback(void* hDevice, Pfn_DirectOutput_PageChange pfnCb, void* pCtxt);
+HRESULT __stdcall DirectOutput_RegisterSoftButtonCallback(void* hDevice, Pfn_DirectOutput_SoftButtonChange pfnCb, void* pCtxt);
+HRESULT __stdcall DirectOutput_SetLed(void* hDevice, DWORD dwPage, DWORD dwIndex, DWORD dwValue);
+HRESULT __stdcall DirectOutput_SetImage(void* hDevice, DWORD dwPage, DWORD dwIndex, DWORD cbValue, const void* pvValue);
+HRESULT __stdcall DirectOutput_GetSerialNumber(void* hDevice, wchar_t* pszSerialNumber, DWORD dwSize);
+'''.replace('HRESULT', 'int64_t').replace('DWORD', 'int32_t')
+
+
+ffibuilder = FFI()
+ffibuilder.cdef(CDEF)
+ffibuilder.set_source(
+    '_libfip',
+    '#include <stdbool.h>\n#include <stdint.h>\n#include <wchar.h>\n#define __stdcall\n' + CDEF,
+    libraries=['libfip'],
+    library_dirs=['./target/debug'],
+    extra_link_args=['-Wl,-rpath,$ORIGIN/target/debug'],
+)
+
+
+if __name__ == '__main__':
+    ffibuilder.compile(verbose=True)
@@ -5,7 +5,7 @@ use rusb::UsbContext;
 use std::{
     collections::BTreeMap,
     io::Read,
-    sync::{Arc, RwLock, Weak},
+    sync::{mpsc, Arc, RwLock, Weak},
 };
 use uuid::Uuid;
 
@@ -19,6 +19,8 @@ pub trait ManagedDisplay: Send + Sync {
     fn save_file(&self, page: u8, file: u8, data: &mut dyn Read) -> Result<(), ()>;
     fn display_file(&self, page: u8, index: u8, file: u8) -> Result<(), ()>;
     fn delete_file(&self, page: u8, file: u8) -> Result<(), ()>;
+    /// Blocks until everything queued for the display (images) has been sent to it
+    fn flush(&self);
 }
 
 pub type UsbDeviceAddress = (u8, u8);
@@ -92,6 +94,21 @@ impl<T: UsbContext + 'static> rusb::Hotplug<T> for UsbHotplugHandler {
             return;
         };
 
+        // handlers are only notified once the display is ready to be used and can be looked up,
+        // so they can call into it right away
+        let (inserted_tx, inserted_rx) = mpsc::sync_channel::<()>(1);
+        let display_hotplug_handlers = self.display_hotplug_handlers.clone();
+        let on_ready = Box::new(move || {
+            if inserted_rx.recv().is_err() {
+                return; // display was never added
+            }
+            let Some(ref rc) = display_hotplug_handlers.upgrade() else { return; };
+            let mut handlers = rc.write().expect("State is poisoned");
+            handlers
+                .iter_mut()
+                .for_each(|handler| handler.display_arrived(addr))
+        });
+
         let display = match (desc.vendor_id(), desc.product_id()) {
             (usb_ids::VID_SAITEK, usb_ids::PID_SAITEK_FIP) => {
                 log::info!(
@@ -99,23 +116,15 @@ impl<T: UsbContext + 'static> rusb::Hotplug<T> for UsbHotplugHandler {
                     bus_number = device.bus_number(),
                     address = device.address()
                 );
-                crate::devices::saitek_fip_lcd::new_from_libusb(device)
+                crate::devices::saitek_fip_lcd::new_from_libusb(device, on_ready)
             }
             _ => return,
         };
 
-        {
-            let Some(ref rc) = self.displays.upgrade() else { return; };
-            let mut displays = rc.write().expect("State is poisoned");
-            displays.insert(addr, display);
-        }
-        {
-            let Some(ref rc) = self.display_hotplug_handlers.upgrade() else { return; };
-            let mut handlers = rc.write().expect("State is poisoned");
-            handlers
-                .iter_mut()
-                .for_each(|handler| handler.display_arrived(addr))
-        }
+        let Some(ref rc) = self.displays.upgrade() else { return; };
+        let mut displays = rc.write().expect("State is poisoned");
+        displays.insert(addr, display);
+        _ = inserted_tx.send(());
     }
 
     fn device_left(&mut self, device: rusb::Device<T>) {
@@ -155,6 +164,12 @@ impl State {
             .collect()
     }
 
+    pub fn flush_displays(&self) {
+        let displays: Vec<Arc<dyn ManagedDisplay>> =
+            self.displays.read().unwrap().values().cloned().collect();
+        displays.iter().for_each(|display| display.flush());
+    }
+
     pub fn display_by_addr(&self, addr: &UsbDeviceAddress) -> Option<Arc<dyn ManagedDisplay>> {
         let displays = self.displays.read().unwrap();
         match displays.get(addr) {
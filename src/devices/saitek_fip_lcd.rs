@@ -2,7 +2,10 @@ use std::{
     cell::OnceCell,
     io::Read,
     mem,
-    sync::{Arc, Mutex, RwLock, Weak},
+    ops::{Deref, DerefMut},
+    ptr::NonNull,
+    slice,
+    sync::{mpsc, Arc, Condvar, Mutex, RwLock, Weak},
     time::Duration, thread::sleep,
 };
 
@@ -14,7 +17,7 @@ use zerocopy::{AsBytes, FromBytes, Unaligned};
 use crate::devices::ManagedDisplay;
 
 struct DeviceHandlerWrapper<T: rusb::UsbContext> {
-    libusb_handle: rusb::DeviceHandle<T>,
+    libusb_handle: Arc<rusb::DeviceHandle<T>>,
     hid_endpoint_address: u8,
     read_endpoint_address: u8,
     write_endpoint_address: u8,
@@ -55,8 +58,128 @@ impl<T: rusb::UsbContext> DeviceHandlerWrapper<T> {
     }
 }
 
+const IMAGE_SIZE: usize = 0x38400;
+// one image is being sent to the device while the next one is being filled in
+const IMAGE_BUFFERS: usize = 2;
+
+/// Buffer the image payload is written from.
+///
+/// Allocated with `libusb_dev_mem_alloc` where the platform supports it (Linux usbfs), so the
+/// kernel can DMA straight from it instead of copying the payload into its own URB buffers.
+/// Keeps the device handle it was allocated for open until it's freed.
+enum ImageBuffer<T: rusb::UsbContext> {
+    DevMem {
+        libusb_handle: Arc<rusb::DeviceHandle<T>>,
+        ptr: NonNull<u8>,
+    },
+    Heap(Box<[u8]>),
+}
+
+// the buffer is owned by exactly one thread at a time, it's passed around through channels
+unsafe impl<T: rusb::UsbContext> Send for ImageBuffer<T> {}
+
+impl<T: rusb::UsbContext> ImageBuffer<T> {
+    fn new(libusb_handle: &Arc<rusb::DeviceHandle<T>>) -> ImageBuffer<T> {
+        let ptr = unsafe { rusb::ffi::libusb_dev_mem_alloc(libusb_handle.as_raw(), IMAGE_SIZE) };
+        match NonNull::new(ptr) {
+            Some(ptr) => ImageBuffer::DevMem {
+                libusb_handle: libusb_handle.clone(),
+                ptr,
+            },
+            None => {
+                log::debug!("Device memory is not available, falling back to a heap buffer");
+                ImageBuffer::Heap(vec![0_u8; IMAGE_SIZE].into_boxed_slice())
+            }
+        }
+    }
+}
+
+impl<T: rusb::UsbContext> Deref for ImageBuffer<T> {
+    type Target = [u8];
+
+    fn deref(&self) -> &[u8] {
+        match self {
+            ImageBuffer::DevMem { ptr, .. } => unsafe {
+                slice::from_raw_parts(ptr.as_ptr(), IMAGE_SIZE)
+            },
+            ImageBuffer::Heap(buffer) => buffer,
+        }
+    }
+}
+
+impl<T: rusb::UsbContext> DerefMut for ImageBuffer<T> {
+    fn deref_mut(&mut self) -> &mut [u8] {
+        match self {
+            ImageBuffer::DevMem { ptr, .. } => unsafe {
+                slice::from_raw_parts_mut(ptr.as_ptr(), IMAGE_SIZE)
+            },
+            ImageBuffer::Heap(buffer) => buffer,
+        }
+    }
+}
+
+impl<T: rusb::UsbContext> Drop for ImageBuffer<T> {
+    fn drop(&mut self) {
+        if let ImageBuffer::DevMem { libusb_handle, ptr } = self {
+            unsafe {
+                rusb::ffi::libusb_dev_mem_free(libusb_handle.as_raw(), ptr.as_ptr(), IMAGE_SIZE);
+            }
+        }
+    }
+}
+
+#[derive(Default)]
+struct PendingImagesState {
+    count: usize,
+    closed: bool, // the images thread is gone, nothing queued is going to be sent anymore
+}
+
+/// Tracks the images queued for (or being sent by) the images thread, so other requests
+/// (and the library deinitialization) can wait for them to reach the device first
+#[derive(Default)]
+struct PendingImages {
+    state: Mutex<PendingImagesState>,
+    drained: Condvar,
+}
+
+impl PendingImages {
+    fn add(&self) {
+        self.state.lock().expect("Device is poisoned").count += 1;
+    }
+
+    fn done(&self) {
+        let mut state = self.state.lock().expect("Device is poisoned");
+        state.count = state.count.saturating_sub(1);
+        if state.count == 0 {
+            self.drained.notify_all();
+        }
+    }
+
+    fn close(&self) {
+        self.state.lock().expect("Device is poisoned").closed = true;
+        self.drained.notify_all();
+    }
+
+    fn wait(&self) {
+        let state = self.state.lock().expect("Device is poisoned");
+        _ = self
+            .drained
+            .wait_while(state, |state| state.count > 0 && !state.closed)
+            .expect("Device is poisoned");
+    }
+}
+
+/// Device thread's ends of the image channels, see `UsbSaitekFipLcd::_image_thread_target`
+struct ImageWriter<T: rusb::UsbContext> {
+    images: mpsc::Receiver<(u8, ImageBuffer<T>)>,
+    free_image_buffers: mpsc::SyncSender<ImageBuffer<T>>,
+}
+
 struct UsbSaitekFipLcdInt<T: rusb::UsbContext> {
     handle: DeviceHandlerWrapper<T>,
+    images: Mutex<mpsc::SyncSender<(u8, ImageBuffer<T>)>>,
+    free_image_buffers: Arc<Mutex<mpsc::Receiver<ImageBuffer<T>>>>,
+    pending_images: Arc<PendingImages>,
     serial_number: String,
     device_type_uuid: Uuid,
     vendor_if_mutex: Mutex<()>,
@@ -67,7 +190,7 @@ struct UsbSaitekFipLcd<T: rusb::UsbContext> {
 }
 
 impl<T: rusb::UsbContext> UsbSaitekFipLcdInt<T> {
-    fn new(dev: &UsbSaitekFipLcd<T>) -> Result<UsbSaitekFipLcdInt<T>, rusb::Error> {
+    fn new(dev: &UsbSaitekFipLcd<T>) -> Result<(UsbSaitekFipLcdInt<T>, ImageWriter<T>), rusb::Error> {
         let mut libusb_handle = dev.libusb_device.open()?;
         let device_descriptor = dev.libusb_device.device_descriptor()?;
         let config_descriptor = dev.libusb_device.active_config_descriptor()?;
@@ -142,7 +265,16 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcdInt<T> {
             device_type_uuid
         );
 
-        Ok(UsbSaitekFipLcdInt {
+        let libusb_handle = Arc::new(libusb_handle);
+        let (images_sender, images) = mpsc::sync_channel(IMAGE_BUFFERS);
+        let (free_image_buffers_sender, free_image_buffers) = mpsc::sync_channel(IMAGE_BUFFERS);
+        for _ in 0..IMAGE_BUFFERS {
+            free_image_buffers_sender
+                .send(ImageBuffer::new(&libusb_handle))
+                .expect("Channel has just been created");
+        }
+
+        let int = UsbSaitekFipLcdInt {
             handle: DeviceHandlerWrapper {
                 libusb_handle,
                 hid_endpoint_address: *hid_endpoint_address
@@ -155,10 +287,18 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcdInt<T> {
                     .get()
                     .expect("Could not find OUT endpoint"),
             },
+            images: Mutex::new(images_sender),
+            free_image_buffers: Arc::new(Mutex::new(free_image_buffers)),
+            pending_images: Arc::default(),
             serial_number,
             device_type_uuid,
             vendor_if_mutex: Mutex::default(),
-        })
+        };
+        let image_writer = ImageWriter {
+            images,
+            free_image_buffers: free_image_buffers_sender,
+        };
+        Ok((int, image_writer))
     }
 }
 
@@ -351,6 +491,10 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcdInt<T> {
             return Err(rusb::Error::Other);
         }
 
+        // The control packet always goes out as its own (short) transfer - that is the only
+        // framing known to work with the device, so it's not coalesced with the payload.
+        // The payload itself is submitted as a single transfer, which libusb splits into URBs
+        // and queues all at once, so there are no gaps between its chunks.
         if let Some(data) = data && !data.is_empty() {
             log::debug!("Write data of len {:?} to device", data.len());
             if self.handle.write_bulk(data, Duration::from_secs(5))? != data.len() {
@@ -393,6 +537,10 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcd<T> {
         control_packet: ControlPacket,
         data: Option<&[u8]>,
     ) -> Result<(ControlPacket, Option<Vec<u8>>), rusb::Error> {
+        // images are sent asynchronously, they have to reach the device before any request
+        // that was made after them
+        self.wait_for_images();
+
         let int_guard = self.int.read().expect("Device is poisoned");
         let int = int_guard
             .as_ref()
@@ -400,10 +548,63 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcd<T> {
         int.transcieve(control_packet, data)
     }
 
-    fn _thread_target(device_weak: Weak<UsbSaitekFipLcd<T>>) {
+    fn wait_for_images(&self) {
+        // the device lock mustn't be held while waiting, the images thread needs it
+        let pending_images = {
+            let int_guard = self.int.read().expect("Device is poisoned");
+            let Some(int) = int_guard.as_ref() else { return };
+            int.pending_images.clone()
+        };
+        pending_images.wait();
+    }
+
+    fn _image_thread_target(
+        device_weak: Weak<UsbSaitekFipLcd<T>>,
+        image_writer: ImageWriter<T>,
+        pending_images: Arc<PendingImages>,
+    ) {
+        UsbSaitekFipLcd::_send_images(device_weak, image_writer, &pending_images);
+        // the images channel is closed by now, release anyone waiting for the images still in it
+        pending_images.close();
+    }
+
+    fn _send_images(
+        device_weak: Weak<UsbSaitekFipLcd<T>>,
+        image_writer: ImageWriter<T>,
+        pending_images: &PendingImages,
+    ) {
+        // ends once the device internals (and the sending half of the channel with them) are gone
+        for (page, image_buffer) in image_writer.images {
+            let Some(device) = device_weak.upgrade() else { return };
+            {
+                let int_guard = device.int.read().expect("Device is poisoned");
+                let Some(int) = int_guard.as_ref() else { return };
+
+                let mut packet = ControlPacket::new(Request::SetImage);
+                packet.set_page(page);
+                packet.set_data_size(image_buffer.len());
+                match int.transcieve(packet, Some(&image_buffer[..])) {
+                    Ok((packet, _)) if packet.has_error() => {
+                        log::error!("Device could not set image: {:?}", packet)
+                    }
+                    Ok(_) => (),
+                    Err(err) => log::error!("Could not send image to device ({})", err),
+                }
+            }
+            pending_images.done();
+            if image_writer.free_image_buffers.send(image_buffer).is_err() {
+                return;
+            }
+        }
+    }
+
+    fn _thread_target(device_weak: Weak<UsbSaitekFipLcd<T>>, on_ready: Box<dyn FnOnce() + Send>)
+    where
+        T: 'static,
+    {
         let Some(device) = device_weak.upgrade() else { return };
-        let device_int = match UsbSaitekFipLcdInt::new(&device) {
-            Ok(device_int) => device_int,
+        let (device_int, image_writer) = match UsbSaitekFipLcdInt::new(&device) {
+            Ok(res) => res,
             Err(rusb::Error::Access) => {
                 sleep(Duration::from_secs(1));
                 UsbSaitekFipLcdInt::new(&device).expect("Cannot open device")
@@ -425,6 +626,27 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcd<T> {
             .expect("Device is poisoned")
             .replace(device_int);
 
+        let image_device_ref = device_weak.clone();
+        let pending_images = device
+            .int
+            .read()
+            .expect("Device is poisoned")
+            .as_ref()
+            .expect("Device internals have just been set")
+            .pending_images
+            .clone();
+        std::thread::Builder::new()
+            .name(format!(
+                "Saitek FIP @ {:03}-{:03} images",
+                device.libusb_device.bus_number(),
+                device.libusb_device.address()
+            ))
+            .spawn(move || {
+                UsbSaitekFipLcd::_image_thread_target(image_device_ref, image_writer, pending_images)
+            })
+            .expect("Could not start device images thread");
+        on_ready();
+
         let mut hid_buffer: [u8; 2] = [0, 0];
 
         loop {
@@ -469,8 +691,10 @@ impl<T: rusb::UsbContext> UsbSaitekFipLcd<T> {
     }
 }
 
+/// `on_ready` is called from the device thread once the device has been initialized
 pub fn new_from_libusb<T: rusb::UsbContext + 'static>(
     libusb_device: rusb::Device<T>,
+    on_ready: Box<dyn FnOnce() + Send>,
 ) -> Arc<dyn ManagedDisplay> {
     let device = Arc::new(UsbSaitekFipLcd {
         libusb_device: libusb_device.clone(),
@@ -484,7 +708,7 @@ pub fn new_from_libusb<T: rusb::UsbContext + 'static>(
             libusb_device.bus_number(),
             libusb_device.address()
         ))
-        .spawn(|| UsbSaitekFipLcd::_thread_target(device_ref))
+        .spawn(move || UsbSaitekFipLcd::_thread_target(device_ref, on_ready))
         .expect("Could not start device thread");
 
     device
@@ -512,14 +736,34 @@ impl<T: rusb::UsbContext> ManagedDisplay for UsbSaitekFipLcd<T> {
     }
 
     fn set_image_data(&self, page: u8, data: &[u8; 0x38400]) -> Result<(), ()> {
-        let mut packet = ControlPacket::new(Request::SetImage);
-        packet.set_page(page);
-        packet.set_data_size(data.len());
-        let (packet, _) = self.transmit(packet, Some(data)).map_err(|_| ())?; // TODO: error
-        match packet.has_error() {
-            false => Ok(()),
-            true => Err(()), // TODO
-        }
+        // the image is only queued here, it's sent by the images thread while the caller goes on
+        // preparing the next one; the device lock mustn't be held while waiting for a buffer
+        let (images, free_image_buffers, pending_images) = {
+            let int_guard = self.int.read().expect("Device is poisoned");
+            let int = int_guard
+                .as_ref()
+                .expect("Device is gone or not initialized yet");
+            (
+                int.images.lock().expect("Device is poisoned").clone(),
+                int.free_image_buffers.clone(),
+                int.pending_images.clone(),
+            )
+        };
+
+        let mut image_buffer = free_image_buffers
+            .lock()
+            .expect("Device is poisoned")
+            .recv()
+            .map_err(|_| ())?; // device is gone
+        image_buffer.copy_from_slice(data);
+        pending_images.add();
+        images.send((page, image_buffer)).map_err(|_| {
+            pending_images.done(); // device is gone
+        })
+    }
+
+    fn flush(&self) {
+        self.wait_for_images();
     }
 
     fn set_led(&self, page: u8, index: u8, value: bool) -> Result<(), ()> {
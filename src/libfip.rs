@@ -107,8 +107,10 @@ directoutputlib_export! {
         log::trace!("DirectOutput_Deinitialize");
 
         let mut state = STATE.lock().expect("State is poisoned");
-        if state.is_some() {
-            drop(state.take());
+        if let Some(state) = state.take() {
+            // images are sent asynchronously, let the queued ones reach the devices
+            state.flush_displays();
+            drop(state);
             log::trace!("App deinitialized, state dropped");
         }
 
@@ -308,6 +310,9 @@ directoutputlib_export! {
         if image.is_null() {
             return E_INVALIDARG;
         }
+        // 320x240, 24bpp bottom-up BGR - the only format the device is known to take; it always
+        // gets the full 0x38400 bytes with the `SetImage` request, so there is no smaller
+        // (e.g. RGB565) payload to send instead
         if image_size != 0x38400 {  // TODO
             return E_BUFFERTOOSMALL;
         }
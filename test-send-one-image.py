@@ -1,20 +1,50 @@
+import array
+import struct
 import sys
-import threading
 import time
-from itertools import chain
 
 import usb.core
 import usb.util
 from PIL import Image
 
 
-def input_thread_target(endpoint_in):
-    while True:
-        try:
-            data = endpoint_in.read(44, timeout=0)
-            print('in:', data)
-        except usb.core.USBError:
-            raise
+# 11 big-endian DWORDs, see `ControlPacket` in src/devices/saitek_fip_lcd.rs
+HDR = struct.Struct('>11I')
+
+# PyUSB copies anything but an `array.array('B')` into a new one on every write
+HEADER_FACTORY_MODE = array.array('B', HDR.pack(
+    0x00,  #  0: (0) ??
+    0x00,  #  1: (1) ??
+    0x00,  #  2: (0)
+    0x00,  #  3: (0) ?? fixed
+    0x00,  #  4: (0) ?? fixed
+    0x0a,  #  5: (6) ??
+    0x00,  #  6: (0) ??
+    0x00,  #  7: (0) ??
+    0x00,  #  8: (0) ??
+    0x00,  #  9: (0) ??
+    0x00,  # 10: (0) ??
+))
+HEADER_SET_IMAGE = array.array('B', HDR.pack(
+    0x00,           #  0: (0) ??
+    0x01,           #  1: (1) ??
+    320 * 240 * 3,  #  2: (320 * 240 * 3 bytes)
+    0x00,           #  3: (0) ?? fixed
+    0x00,           #  4: (0) ?? fixed
+    0x06,           #  5: (6) ??
+    0x00,           #  6: (0) ??
+    0x00,           #  7: (0) ??
+    0x00,           #  8: (0) ??
+    0x00,           #  9: (0) ??
+    0x00,           # 10: (0) ??
+))
+
+
+def read_response(endpoint_in):
+    # the device answers every request with a control packet of its own
+    data = endpoint_in.read(HDR.size, timeout=5000)
+    print('in:', data)
+    return data
 
 
 def main():
@@ -48,63 +78,41 @@ def main():
         )
     )
 
-    t = threading.Thread(target=input_thread_target, args=(endpoint_in,), daemon=True)
-    t.start()
-
     while True:
         # endpoint_out.clear_halt()
-        b = bytearray(44)
-        b[ 3], b[ 2], b[ 1], b[ 0] = (0x00, 0x00, 0x00, 0x00)[::1]  #  0: (0) ??
-        b[ 7], b[ 6], b[ 5], b[ 4] = (0x00, 0x00, 0x00, 0x00)[::1]  #  1: (1) ??
-        b[11], b[10], b[ 9], b[ 8] = (0x00, 0x00, 0x00, 0x00)[::1]  #  2: (0)
-        b[15], b[14], b[13], b[12] = (0x00, 0x00, 0x00, 0x00)[::1]  #  3: (0) ?? fixed
-        b[19], b[18], b[17], b[16] = (0x00, 0x00, 0x00, 0x00)[::1]  #  4: (0) ?? fixed
-        b[23], b[22], b[21], b[20] = (0x0a, 0x00, 0x00, 0x00)[::1]  #  5: (6) ??
-        b[27], b[26], b[25], b[24] = (0x00, 0x00, 0x00, 0x00)[::1]  #  6: (0) ??
-        b[31], b[30], b[29], b[28] = (0x00, 0x00, 0x00, 0x00)[::1]  #  7: (0) ??
-        b[35], b[34], b[33], b[32] = (0x00, 0x00, 0x00, 0x00)[::1]  #  8: (0) ??
-        b[39], b[38], b[37], b[36] = (0x00, 0x00, 0x00, 0x00)[::1]  #  9: (0) ??
-        b[43], b[42], b[41], b[40] = (0x00, 0x00, 0x00, 0x00)[::1]  # 10: (0) ??
         try:
-            endpoint_out.write(b, timeout=5000)
-            print('out:', b)
+            endpoint_out.write(HEADER_FACTORY_MODE, timeout=5000)
+            print('out:', HEADER_FACTORY_MODE)
         except usb.core.USBTimeoutError:
             # device.reset()
             continue
         else:
             break
+    read_response(endpoint_in)
     print('!!!!')
 
-    b = bytearray(44)
-    b[ 3], b[ 2], b[ 1], b[ 0] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  0: (0) ??
-    b[ 7], b[ 6], b[ 5], b[ 4] = (0x00, 0x00, 0x00, 0x01)[::-1]  #  1: (1) ??
-    b[11], b[10], b[ 9], b[ 8] = (0x00, 0x03, 0x84, 0x00)[::-1]  #  2: (320 * 240 * 3 bytes)
-    b[15], b[14], b[13], b[12] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  3: (0) ?? fixed
-    b[19], b[18], b[17], b[16] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  4: (0) ?? fixed
-    b[23], b[22], b[21], b[20] = (0x00, 0x00, 0x00, 0x06)[::-1]  #  5: (6) ??
-    b[27], b[26], b[25], b[24] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  6: (0) ??
-    b[31], b[30], b[29], b[28] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  7: (0) ??
-    b[35], b[34], b[33], b[32] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  8: (0) ??
-    b[39], b[38], b[37], b[36] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  9: (0) ??
-    b[43], b[42], b[41], b[40] = (0x00, 0x00, 0x00, 0x00)[::-1]  # 10: (0) ??
-    image_pixels = chain.from_iterable(Image.open('SMPTEColor.png').resize((320, 240)).getdata())
-    endpoint_out.write(b, timeout=5000)
-    print('out:', b)
-    endpoint_out.write(bytes(image_pixels), timeout=5000)
+    image_pixels = array.array('B', Image.open('SMPTEColor.png').resize((320, 240)).tobytes())
+    endpoint_out.write(HEADER_SET_IMAGE, timeout=5000)
+    print('out:', HEADER_SET_IMAGE)
+    endpoint_out.write(image_pixels, timeout=5000)
     print('out:', '[image data]')
+    read_response(endpoint_in)
 
-    # b = bytearray(44)
-    # b[ 3], b[ 2], b[ 1], b[ 0] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  0: (0) ??
-    # b[ 7], b[ 6], b[ 5], b[ 4] = (0x00, 0x00, 0x00, 0x01)[::-1]  #  1: (1) ??
-    # b[11], b[10], b[ 9], b[ 8] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  2: (0)
-    # b[15], b[14], b[13], b[12] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  3: (0) ?? fixed
-    # b[19], b[18], b[17], b[16] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  4: (0) ?? fixed
-    # b[23], b[22], b[21], b[20] = (0x13, 0x00, 0x00, 0x00)[::-1]  #  5: (6) ??
-    # b[27], b[26], b[25], b[24] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  6: (0) ??
-    # b[31], b[30], b[29], b[28] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  7: (0) ??
-    # b[35], b[34], b[33], b[32] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  8: (0) ??
-    # b[39], b[38], b[37], b[36] = (0x00, 0x00, 0x00, 0x00)[::-1]  #  9: (0) ??
-    # b[43], b[42], b[41], b[40] = (0x00, 0x00, 0x00, 0x00)[::-1]  # 10: (0) ??
+    # b = bytearray(HDR.size)
+    # HDR.pack_into(
+    #     b, 0,
+    #     0x00,  #  0: (0) ??
+    #     0x01,  #  1: (1) ??
+    #     0x00,  #  2: (0)
+    #     0x00,  #  3: (0) ?? fixed
+    #     0x00,  #  4: (0) ?? fixed
+    #     0x13,  #  5: (6) ??
+    #     0x00,  #  6: (0) ??
+    #     0x00,  #  7: (0) ??
+    #     0x00,  #  8: (0) ??
+    #     0x00,  #  9: (0) ??
+    #     0x00,  # 10: (0) ??
+    # )
     # endpoint_out.write(b)
 
 
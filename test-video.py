@@ -1,41 +1,24 @@
-import time
-from pathlib import Path
-
-from PIL import Image
-from cffi import FFI
-
-
-f = FFI()
-#f.cdef(Path('./target/libfip.h').read_text())
-f.cdef(
-'''
-typedef void (__stdcall *Pfn_DirectOutput_EnumerateCallback)(void* hDevice, void* pCtxt);
-typedef void (__stdcall *Pfn_DirectOutput_DeviceChange)(void* hDevice, bool bAdded, void* pCtxt);
-typedef void (__stdcall *Pfn_DirectOutput_PageChange)(void* hDevice, DWORD dwPage, bool bSetActive, void* pCtxt);
-typedef void (__stdcall *Pfn_DirectOutput_SoftButtonChange)(void* hDevice, DWORD dwButtons, void* pCtxt);
-
-HRESULT __stdcall DirectOutput_Initialize(const wchar_t* wszPluginName);
-HRESULT __stdcall DirectOutput_Deinitialize();
-HRESULT __stdcall DirectOutput_RegisterDeviceCallback(Pfn_DirectOutput_DeviceChange pfnCb, void* pCtxt);
-HRESULT __stdcall DirectOutput_Enumerate(Pfn_DirectOutput_EnumerateCallback pfnCb, void* pCtxt);
-HRESULT __stdcall DirectOutput_RegisterPageCallback(void* hDevice, Pfn_DirectOutput_PageChange pfnCb, void* pCtxt);
-HRESULT __stdcall DirectOutput_RegisterSoftButtonCallback(void* hDevice, Pfn_DirectOutput_SoftButtonChange pfnCb, void* pCtxt);
-HRESULT __stdcall DirectOutput_SetLed(void* hDevice, DWORD dwPage, DWORD dwIndex, DWORD dwValue);
-HRESULT __stdcall DirectOutput_SetImage(void* hDevice, DWORD dwPage, DWORD dwIndex, DWORD cbValue, const void* pvValue);
-HRESULT __stdcall DirectOutput_GetSerialNumber(void* hDevice, wchar_t* pszSerialNumber, DWORD dwSize);
-'''.replace('HRESULT', 'int64_t').replace('DWORD', 'int32_t')
-)
-m = f.dlopen('./liblibfip.so')
+# built by build_libfip.py
+from _libfip import ffi as f, lib as m
 
 
 import av
-import queue
+import multiprocessing
+import numpy as np
 import sys
 import threading
-from itertools import chain
+from av.video.reformatter import VideoReformatter
+from multiprocessing import shared_memory
+
+
+# SetImage expects raw BMP pixel data: bottom-up rows of BGR pixels
+FRAME_SHAPE = (240, 320, 3)
+FRAME_SIZE = 320 * 240 * 3
+FRAME_SLOTS = 2
 
 
 device_addr = None
+device_ready = threading.Event()
 
 
 @f.callback("void(void*, void *)")
@@ -43,32 +26,104 @@ def enumerate_callback(addr, handle):
     global device_addr
     print('enumerate_callback', addr, handle)
     device_addr = addr
+    device_ready.set()
 
 
-def thread_target(q):
-    while True:
-        image_pixels = q.get()
-        m.DirectOutput_SetImage(device_addr, 0, 0, len(image_pixels), image_pixels)
-
-
-m.DirectOutput_Initialize('test')
-try:
-    x = f.new("int *")
-    import time; time.sleep(0.5)
-    m.DirectOutput_Enumerate(enumerate_callback, x)
-    if device_addr is None:
-        print('No devices found!')
-        exit(1)
-
-    container = av.open(sys.argv[1])
-
-    q = queue.Queue(32)
-    threading.Thread(target=thread_target, args=(q,), daemon=True).start()
-    for packet in container.demux():
-        for i, frame in enumerate(packet.decode()):
-            if isinstance(frame, av.video.frame.VideoFrame):
-                img = frame.to_image().resize((320, 240))
-                image_pixels = bytes(chain.from_iterable(img.getdata()))[::-1]
-                q.put(image_pixels)
-finally:
-    m.DirectOutput_Deinitialize()
+@f.callback("void(void*, bool, void *)")
+def device_change_callback(addr, is_added, handle):
+    global device_addr
+    print('device_change_callback', addr, is_added, handle)
+    if is_added:
+        device_addr = addr
+        device_ready.set()
+
+
+def send_loop(shm_name, ready, stop, filled, empty):
+    # the device can only be claimed by a single process, so all library calls happen here
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frame_ptrs = [
+        f.from_buffer('uint8_t[]', shm.buf[slot * FRAME_SIZE:(slot + 1) * FRAME_SIZE])
+        for slot in range(FRAME_SLOTS)
+    ]
+
+    m.DirectOutput_Initialize('test')
+    try:
+        x = f.new("int *")
+        # devices that are not ready yet are reported through the callback once they are
+        m.DirectOutput_RegisterDeviceCallback(device_change_callback, x)
+        m.DirectOutput_Enumerate(enumerate_callback, x)
+        if not device_ready.wait(2.0):
+            print('No devices found!')
+            exit(1)
+        ready.set()
+
+        slot = 0
+        while True:
+            if not filled.acquire(timeout=0.1):
+                if not stop.is_set():
+                    continue
+                # the stream has ended, send what was queued before that and finish
+                if not filled.acquire(block=False):
+                    break
+            m.DirectOutput_SetImage(device_addr, 0, 0, FRAME_SIZE, frame_ptrs[slot])
+            empty.release()
+            slot = (slot + 1) % FRAME_SLOTS
+    finally:
+        m.DirectOutput_Deinitialize()
+
+
+def main():
+    shm = shared_memory.SharedMemory(create=True, size=FRAME_SIZE * FRAME_SLOTS)
+    frames = np.ndarray((FRAME_SLOTS, *FRAME_SHAPE), dtype=np.uint8, buffer=shm.buf)
+    try:
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        filled = multiprocessing.Semaphore(0)
+        empty = multiprocessing.Semaphore(FRAME_SLOTS)
+        sender = multiprocessing.Process(
+            target=send_loop, args=(shm.name, ready, stop, filled, empty), daemon=True
+        )
+        sender.start()
+        while not ready.wait(0.1):
+            if not sender.is_alive():
+                exit(1)
+
+        container = av.open(sys.argv[1])
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'  # frame and slice threading, thread count picked by libavcodec
+
+        # a single reformatter keeps its swscale context around instead of setting up a new one
+        # (with all of its filter tables) for every frame
+        reformatter = VideoReformatter()
+        slot = 0
+        sent_any = False
+        for frame in container.decode(stream):
+            plane = reformatter.reformat(
+                frame, width=320, height=240, format='bgr24', interpolation='FAST_BILINEAR'
+            ).planes[0]
+            # view the plane memory in place, rows may be padded up to `line_size`
+            pixels = np.frombuffer(plane, dtype=np.uint8, count=240 * plane.line_size)
+            pixels = pixels.reshape(240, plane.line_size)[:, :FRAME_SIZE // 240]
+            pixels = pixels.reshape(FRAME_SHAPE)[::-1]
+            if sent_any and np.array_equal(pixels, frames[(slot - 1) % FRAME_SLOTS]):
+                # same picture as the one already sent, no need to wait for a free slot
+                continue
+            while not empty.acquire(timeout=0.1):
+                if not sender.is_alive():
+                    exit(1)
+            np.copyto(frames[slot], pixels)
+            sent_any = True
+            filled.release()
+            slot = (slot + 1) % FRAME_SLOTS
+
+        # let the sender drain the queued frames and deinitialize the library
+        stop.set()
+        sender.join()
+    finally:
+        del frames  # releases the exported shared memory buffer
+        shm.close()
+        shm.unlink()
+
+
+if __name__ == '__main__':
+    main()